@@ -0,0 +1,448 @@
+from collections import Counter, defaultdict
+import itertools
+import functools
+import threading
+import tracemalloc
+import cProfile
+import pstats
+import time
+import sys
+import io
+import os
+
+
+class PipelineProfiler:
+    """Class to profile the pipeline stages and write hot-path reports."""
+
+    # cprofile: deterministic profile of every call inside the stages, written as a .prof file
+    # sampling: periodic stack samples of the threads inside the stages, written as folded stacks (flamegraph.pl, speedscope)
+    MODES = ['cprofile', 'sampling']
+    # a new allocation snapshot is only taken once the traced memory grew by this factor
+    SNAPSHOT_GROWTH = 1.25
+
+    def __init__(self, mode: str = 'cprofile', trace_memory: bool = False, top_n: int = 20, sampling_interval: float = 0.005):
+        """
+        Initialize PipelineProfiler.
+
+        Args:
+            mode (str): Profiler to run inside the stages, one of MODES.
+            trace_memory (bool): Trace the memory allocations with tracemalloc.
+            top_n (int): Number of functions and allocation sites in the summary.
+            sampling_interval (float): Seconds between two stack samples in the sampling mode.
+
+        Raises:
+            ValueError: If the mode is not supported.
+
+        """
+        if mode not in self.MODES:
+            raise ValueError(f'Unsupported profile mode: {mode}, expected one of {self.MODES}')
+        self.mode: str = mode
+        self.trace_memory: bool = trace_memory
+        self.top_n: int = top_n
+        self.sampling_interval: float = sampling_interval
+        # {stage_name: total seconds}, {stage_name: number of calls}
+        self.stage_times: dict = defaultdict(float)
+        self.stage_calls: dict = defaultdict(int)
+        # the stages are called from worker threads
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # [(cls, name, original attribute)] restored by stop()
+        self._originals: list = []
+        # cprofile: one profile per thread entering a stage
+        self._profiles: list = []
+        self._failed_profiles: int = 0
+        # sampling: idents of the threads inside a stage and {folded stack: samples}
+        self._active_threads: set = set()
+        self._stacks: Counter = Counter()
+        self._stop_event = threading.Event()
+        self._sampler: threading.Thread = None
+        # trace_memory: {stage_name: highest traced memory above the stage's start}
+        self.stage_memory_peaks: dict = defaultdict(int)
+        # {measurement id: [traced memory at the stage's start, highest peak seen since]} of the running stages
+        self._memory_measurements: dict = {}
+        self._measurement_ids = itertools.count()
+        self._memory_peak: int = 0
+        # snapshot at the outermost stage exit with the most traced memory, while the pipeline data is alive
+        self._memory_snapshot: tracemalloc.Snapshot = None
+        self._memory_snapshot_stage: tuple = None
+        self._memory_usage: tuple = None
+        self._wall_time: float = 0
+
+    def instrument(self, cls, method_names: list[str]):
+        """
+        Wrap methods of a class so every call is recorded as a stage.
+
+        The class is patched, so instances created afterwards (including calls in __init__) are recorded.
+
+        Args:
+            cls (type): Class to instrument.
+            method_names (list[str]): Names of the methods to record.
+
+        """
+        for name in method_names:
+            original = cls.__dict__[name]
+            self._originals.append((cls, name, original))
+            setattr(cls, name, self._wrap_stage(f'{cls.__name__}.{name}', original))
+
+    def _wrap_stage(self, stage_name: str, func):
+        """
+        Wrap a function to time it and run the profiler while it is called.
+
+        Args:
+            stage_name (str): Name of the stage in the report.
+            func (callable): Function to wrap.
+
+        Returns:
+            callable: Wrapped function.
+
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            depth = getattr(self._local, 'depth', 0)
+            # the memory bookkeeping of the outermost stage runs before the profiler starts and after it stops
+            measurement = self._enter_memory() if self.trace_memory else None
+            # only the outermost stage of a thread starts the profiler
+            profile = self._enter_thread() if depth == 0 else None
+            self._local.depth = depth + 1
+            start_time = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start_time
+                self._local.depth = depth
+                if depth == 0:
+                    self._leave_thread(profile)
+                if measurement is not None:
+                    # only the outermost stage snapshots the allocations, outside of the profiler
+                    self._leave_memory(stage_name, measurement, allow_snapshot=depth == 0)
+                with self._lock:
+                    self.stage_times[stage_name] += elapsed
+                    self.stage_calls[stage_name] += 1
+        return wrapper
+
+    def _enter_thread(self) -> cProfile.Profile:
+        """
+        Start profiling the current thread.
+
+        Returns:
+            cProfile.Profile: Profile of the thread, None in the sampling mode or if it could not be enabled.
+
+        """
+        if self.mode == 'sampling':
+            with self._lock:
+                self._active_threads.add(threading.get_ident())
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is active, reported in the summary
+            with self._lock:
+                self._failed_profiles += 1
+            return None
+        with self._lock:
+            self._profiles.append(profile)
+        return profile
+
+    def _leave_thread(self, profile: cProfile.Profile):
+        """
+        Stop profiling the current thread.
+
+        Args:
+            profile (cProfile.Profile): Profile returned by _enter_thread.
+
+        """
+        if profile is not None:
+            profile.disable()
+        if self.mode == 'sampling':
+            with self._lock:
+                self._active_threads.discard(threading.get_ident())
+
+    def _update_memory_peaks(self) -> int:
+        """
+        Fold the traced peak into the running stages and reset it. The caller holds the lock.
+
+        Returns:
+            int: Currently traced memory in bytes.
+
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        for measurement in self._memory_measurements.values():
+            measurement[1] = max(measurement[1], peak)
+        self._memory_peak = max(self._memory_peak, peak)
+        tracemalloc.reset_peak()
+        return current
+
+    def _enter_memory(self) -> int:
+        """
+        Start measuring the peak memory of a stage.
+
+        Returns:
+            int: Id of the measurement, passed to _leave_memory.
+
+        """
+        with self._lock:
+            current = self._update_memory_peaks()
+            measurement = next(self._measurement_ids)
+            self._memory_measurements[measurement] = [current, current]
+        return measurement
+
+    def _leave_memory(self, stage_name: str, measurement: int, allow_snapshot: bool):
+        """
+        Record the peak memory of a stage and snapshot the allocations if the traced memory
+        grew by SNAPSHOT_GROWTH since the last snapshot.
+
+        Args:
+            stage_name (str): Name of the stage.
+            measurement (int): Id returned by _enter_memory.
+            allow_snapshot (bool): Whether the stage may take a snapshot, only the outermost stage of a thread does.
+
+        """
+        with self._lock:
+            current = self._update_memory_peaks()
+            start, peak = self._memory_measurements.pop(measurement)
+            self.stage_memory_peaks[stage_name] = max(self.stage_memory_peaks[stage_name], peak - start)
+            take_snapshot = allow_snapshot and (
+                self._memory_snapshot_stage is None or current > self._memory_snapshot_stage[1] * self.SNAPSHOT_GROWTH)
+            if take_snapshot:
+                self._memory_snapshot_stage = (stage_name, current)
+        if take_snapshot:
+            snapshot = tracemalloc.take_snapshot()
+            with self._lock:
+                if self._memory_snapshot_stage == (stage_name, current):
+                    self._memory_snapshot = snapshot
+
+    def _sample_stacks(self):
+        """
+        Record the stacks of the threads inside a stage until stop() is called.
+
+        """
+        sampler_ident = threading.get_ident()
+        while not self._stop_event.wait(self.sampling_interval):
+            with self._lock:
+                active_threads = set(self._active_threads)
+            for thread_ident, frame in sys._current_frames().items():
+                if thread_ident == sampler_ident or thread_ident not in active_threads:
+                    continue
+                # the thread runs the profiler's own bookkeeping, not a stage
+                if frame.f_code.co_filename == __file__:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    # leave out the stage wrappers
+                    if code.co_filename != __file__:
+                        stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                # folded stack: outermost frame first
+                self._stacks[';'.join(reversed(stack))] += 1
+
+    @staticmethod
+    def _single_profiler_only() -> bool:
+        """
+        Check whether the interpreter allows only one active cProfile at a time.
+
+        Python 3.12+ profiles through sys.monitoring, which is interpreter-wide: a second
+        profile cannot be enabled, and the active one records the calls of every thread.
+
+        Returns:
+            bool: True if a second profile cannot be enabled, or if another profiler is already active.
+
+        """
+        first_profile, second_profile = cProfile.Profile(), cProfile.Profile()
+        try:
+            first_profile.enable()
+        except ValueError:
+            # the pipeline runs under another profiler, e.g. python -m cProfile app.py
+            return True
+        try:
+            second_profile.enable()
+        except ValueError:
+            return True
+        finally:
+            second_profile.disable()
+            first_profile.disable()
+        return False
+
+    def start(self):
+        """
+        Start the memory tracing and the stack sampler.
+
+        """
+        self._wall_time = time.perf_counter()
+        if self.trace_memory:
+            tracemalloc.start()
+        if self.mode == 'cprofile' and self._single_profiler_only():
+            # a single profile would record the calls of every thread, including the main thread waiting for the workers
+            print('Warning: only one cProfile can be active, using the sampling mode to profile the worker threads.')
+            self.mode = 'sampling'
+        if self.mode == 'sampling':
+            self._stop_event.clear()
+            self._sampler = threading.Thread(target=self._sample_stacks, name='PipelineProfilerSampler', daemon=True)
+            self._sampler.start()
+
+    def stop(self):
+        """
+        Stop profiling and restore the instrumented methods.
+
+        """
+        self._wall_time = time.perf_counter() - self._wall_time
+        if self._sampler is not None:
+            self._stop_event.set()
+            self._sampler.join()
+            self._sampler = None
+        if self.trace_memory and tracemalloc.is_tracing():
+            with self._lock:
+                current = self._update_memory_peaks()
+            self._memory_usage = (current, self._memory_peak)
+            tracemalloc.stop()
+        for cls, name, original in reversed(self._originals):
+            setattr(cls, name, original)
+        self._originals = []
+
+    def write_report(self, output_prefix: str) -> list[str]:
+        """
+        Write the profile and the top-N summary.
+
+        Args:
+            output_prefix (str): Path without extension, e.g. "result" for the output "result.geojson".
+
+        Returns:
+            list[str]: Paths of the written files.
+            - <prefix>.profile.txt: stage timings, top-N hot functions and allocation sites.
+            - <prefix>.prof: pstats file in the cprofile mode (snakeviz, flameprof, gprof2dot).
+            - <prefix>.folded: folded stacks in the sampling mode (flamegraph.pl, speedscope).
+
+        """
+        report = [self._format_stage_times()]
+        paths = []
+        if self.mode == 'cprofile':
+            report.append(self._write_cprofile(output_prefix + '.prof'))
+            paths.append(output_prefix + '.prof')
+        else:
+            report.append(self._write_folded_stacks(output_prefix + '.folded'))
+            paths.append(output_prefix + '.folded')
+        if self._memory_snapshot is not None:
+            report.append(self._format_memory())
+
+        summary_path = output_prefix + '.profile.txt'
+        with open(summary_path, 'w') as f:
+            f.write('\n'.join(report))
+        return [summary_path] + paths
+
+    def _format_stage_times(self) -> str:
+        """
+        Format the time spent in each stage.
+
+        Returns:
+            str: Table of the stages sorted by total time, with their peak memory if traced.
+
+        """
+        lines = [
+            f"{'='*50}",
+            f"* Stage Times (wall time: {self._wall_time:.2f} seconds)",
+        ]
+        if self.trace_memory:
+            lines.append("* peak(MiB): traced memory above the stage's start, including stages running in other threads")
+        lines += [
+            f"{'='*50}",
+            f"{'total(s)':>10} {'calls':>7} {'mean(s)':>10}" + (f" {'peak(MiB)':>10}" if self.trace_memory else '') + "  stage",
+        ]
+        for stage_name, total_time in sorted(self.stage_times.items(), key=lambda item: item[1], reverse=True):
+            calls = self.stage_calls[stage_name]
+            peak = f" {self.stage_memory_peaks[stage_name] / 2**20:>10.1f}" if self.trace_memory else ''
+            lines.append(f"{total_time:>10.3f} {calls:>7} {total_time / calls:>10.4f}{peak}  {stage_name}")
+        return '\n'.join(lines) + '\n'
+
+    def _write_cprofile(self, prof_path: str) -> str:
+        """
+        Merge the thread profiles, dump them and format the top-N functions.
+
+        Args:
+            prof_path (str): Path of the pstats file.
+
+        Returns:
+            str: Top-N functions by cumulative and by own time.
+
+        """
+        if not self._profiles:
+            return 'No profile was recorded.\n'
+        stream = io.StringIO()
+        if self._failed_profiles:
+            stream.write(f"* {self._failed_profiles} stage calls were not profiled, another profiler was active\n")
+        stats = pstats.Stats(*self._profiles, stream=stream)
+        stats.dump_stats(prof_path)
+        self._drop_profiler_functions(stats)
+        stats.strip_dirs()
+        for sort_key in ['cumulative', 'tottime']:
+            stream.write(f"{'='*50}\n* Top {self.top_n} functions by {sort_key}\n{'='*50}\n")
+            stats.sort_stats(sort_key).print_stats(self.top_n)
+        return stream.getvalue()
+
+    @staticmethod
+    def _drop_profiler_functions(stats: pstats.Stats):
+        """
+        Remove the functions of this module (stage wrappers and bookkeeping) from the stats.
+
+        Args:
+            stats (pstats.Stats): Stats before strip_dirs, so the file names are the ones of the code objects.
+
+        """
+        for function in [function for function in stats.stats if function[0] == __file__]:
+            del stats.stats[function]
+        for _, _, _, _, callers in stats.stats.values():
+            for function in [function for function in callers if function[0] == __file__]:
+                del callers[function]
+
+    def _write_folded_stacks(self, folded_path: str) -> str:
+        """
+        Write the folded stacks and format the top-N functions.
+
+        Args:
+            folded_path (str): Path of the folded stacks file.
+
+        Returns:
+            str: Top-N functions by own and by total samples.
+
+        """
+        with open(folded_path, 'w') as f:
+            for stack, samples in self._stacks.most_common():
+                f.write(f'{stack} {samples}\n')
+
+        total_samples = sum(self._stacks.values())
+        if total_samples == 0:
+            return 'No stack was sampled.\n'
+        own_samples = Counter()
+        cumulative_samples = Counter()
+        for stack, samples in self._stacks.items():
+            frames = stack.split(';')
+            own_samples[frames[-1]] += samples
+            for frame in set(frames):
+                cumulative_samples[frame] += samples
+
+        lines = []
+        for title, counter in [('own', own_samples), ('total', cumulative_samples)]:
+            lines += [f"{'='*50}", f"* Top {self.top_n} functions by {title} samples ({total_samples} samples)", f"{'='*50}"]
+            for frame, samples in counter.most_common(self.top_n):
+                lines.append(f"{samples:>8} {100 * samples / total_samples:>6.1f}%  {frame}")
+        return '\n'.join(lines) + '\n'
+
+    def _format_memory(self) -> str:
+        """
+        Format the traced memory and the top-N allocation sites.
+
+        Returns:
+            str: Memory usage and allocation sites at the outermost stage exit with the most traced memory.
+
+        """
+        current, peak = self._memory_usage
+        snapshot_stage, snapshot_memory = self._memory_snapshot_stage
+        lines = [
+            f"{'='*50}",
+            f"* Memory: peak {peak / 2**20:.1f} MiB, current at stop {current / 2**20:.1f} MiB",
+            f"* Top {self.top_n} allocation sites after {snapshot_stage} ({snapshot_memory / 2**20:.1f} MiB traced)",
+            f"{'='*50}",
+        ]
+        for statistic in self._memory_snapshot.statistics('lineno')[:self.top_n]:
+            lines.append(str(statistic))
+        return '\n'.join(lines) + '\n'
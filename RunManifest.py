@@ -0,0 +1,187 @@
+import numpy as np
+import threading
+import json
+import os
+
+
+class RunManifest:
+    """Class to record the progress of each month so an interrupted run can be resumed."""
+
+    # stages of a month in processing order
+    DOWNLOADED = 'downloaded'
+    EXTRACTED = 'extracted'
+    AGGREGATED = 'aggregated'
+    STAGES = [DOWNLOADED, EXTRACTED, AGGREGATED]
+
+    def __init__(self, checkpoint_dir: str, run_key: dict, result_key: dict = None):
+        """
+        Initialize RunManifest and load the manifest of a previous run if it matches.
+
+        Args:
+            checkpoint_dir (str): Directory of the manifest and the partial results.
+            run_key (dict): Values the downloaded data depends on, e.g. {'bbox': [...]}.
+            - A manifest written with a different run_key is discarded.
+            result_key (dict): Values the monthly averages depend on, e.g. {'file_hash': ..., 'sampling_mode': ...}.
+            - An aggregated month saved with a different result_key is aggregated again from its extracted files.
+
+        """
+        self.checkpoint_dir: str = checkpoint_dir
+        self.manifest_path: str = os.path.join(checkpoint_dir, 'manifest.json')
+        self.run_key: dict = json.loads(json.dumps(run_key))
+        self.result_key: dict = json.loads(json.dumps(result_key or {}))
+        # worker threads update the manifest concurrently
+        self._lock = threading.Lock()
+        # {'202301': {'stage': 'aggregated', 'days': [...], 'files': [...], 'result_key': {...}}}
+        self.months: dict = self._load_manifest()
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def _load_manifest(self) -> dict:
+        """
+        Load the months of the previous run.
+
+        Returns:
+            dict: State of each month, empty if there is no manifest or it belongs to another run.
+
+        """
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get('run_key') != self.run_key:
+            print(f'Ignoring checkpoint of a different run: {self.manifest_path}')
+            return {}
+        return manifest.get('months', {})
+
+    def _save_manifest(self):
+        """
+        Write the manifest atomically, so an interrupted write never corrupts it.
+
+        """
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'run_key': self.run_key, 'months': self.months}, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _result_path(self, month: str) -> str:
+        """
+        Get the path of the saved monthly average temperature of a month.
+
+        Args:
+            month (str): Month, e.g. "202301".
+
+        Returns:
+            str: Path of the .npy file in the checkpoint directory.
+
+        """
+        return os.path.join(self.checkpoint_dir, f'{month}.npy')
+
+    def get_stage(self, month: str, days: list[str]) -> str:
+        """
+        Get the last completed stage of a month.
+
+        Args:
+            month (str): Month, e.g. "202301".
+            days (list[str]): Days requested for the month; a month recorded with other days
+            (e.g. the current month of a previous run) starts again.
+
+        Returns:
+            str: The last completed stage, or None if the month has to start from the download.
+            - A month aggregated with another result_key is only extracted for this run.
+
+        """
+        with self._lock:
+            state = self.months.get(month)
+        if state is None or state['days'] != list(days):
+            return None
+        if state['stage'] == self.AGGREGATED and state.get('result_key') != self.result_key:
+            return self.EXTRACTED
+        return state['stage']
+
+    def is_completed(self, month: str, days: list[str], stage: str) -> bool:
+        """
+        Check whether a month has reached the given stage.
+
+        Args:
+            month (str): Month, e.g. "202301".
+            days (list[str]): Days requested for the month.
+            stage (str): One of RunManifest.STAGES.
+
+        Returns:
+            bool: True if the stage or a later one is completed.
+
+        """
+        current_stage = self.get_stage(month, days)
+        return current_stage is not None and self.STAGES.index(current_stage) >= self.STAGES.index(stage)
+
+    def get_files(self, month: str) -> list[str]:
+        """
+        Get the extracted netCDF file names of a month.
+
+        Args:
+            month (str): Month, e.g. "202301".
+
+        Returns:
+            list[str]: File names recorded when the month was extracted.
+
+        """
+        with self._lock:
+            return list(self.months[month]['files'])
+
+    def mark_stage(self, month: str, days: list[str], stage: str, files: list[str] = None):
+        """
+        Record a completed stage of a month.
+
+        Args:
+            month (str): Month, e.g. "202301".
+            days (list[str]): Days of the month.
+            stage (str): One of RunManifest.STAGES.
+            files (list[str]): Extracted netCDF file names, kept from the previous stage if None.
+
+        """
+        with self._lock:
+            state = self.months.get(month, {})
+            if files is None:
+                files = state.get('files', [])
+            self.months[month] = {'stage': stage, 'days': list(days), 'files': list(files)}
+            if stage == self.AGGREGATED:
+                self.months[month]['result_key'] = self.result_key
+            self._save_manifest()
+
+    def reset_month(self, month: str):
+        """
+        Forget the progress of a month, so the next run starts it again from the download.
+
+        Args:
+            month (str): Month, e.g. "202301".
+
+        """
+        with self._lock:
+            if self.months.pop(month, None) is not None:
+                self._save_manifest()
+
+    def save_monthly_average(self, month: str, days: list[str], monthly_average: np.ndarray):
+        """
+        Save the monthly average temperature of a month and mark it as aggregated.
+
+        Args:
+            month (str): Month, e.g. "202301".
+            days (list[str]): Days of the month.
+            monthly_average (np.ndarray): Monthly average temperature of each centroid.
+
+        """
+        np.save(self._result_path(month), monthly_average)
+        self.mark_stage(month, days, self.AGGREGATED)
+
+    def load_monthly_average(self, month: str) -> np.ndarray:
+        """
+        Load the saved monthly average temperature of a month.
+
+        Args:
+            month (str): Month, e.g. "202301".
+
+        Returns:
+            np.ndarray: Monthly average temperature of each centroid.
+
+        """
+        return np.load(self._result_path(month))
@@ -1,13 +1,24 @@
+from RunManifest import RunManifest
+
 import cdsapi
 import tarfile
+import shutil
 import os
 
 
 class TemperatureDataDownloader:
     """Class to download temperature data using the Climate Data Store (CDS) API."""
 
-    def __init__(self):
+    def __init__(self, manifest: RunManifest = None):
+        """
+        Initialize TemperatureDataDownloader.
+
+        Args:
+            manifest (RunManifest): Optional manifest to skip the stages completed by a previous run.
+
+        """
         self.cds_client = cdsapi.Client()
+        self.manifest = manifest
         # {'202301':[nc_file_name,...],'202302':[nc_file_name]}
         self.nc_file_list_by_month = {}
 
@@ -22,11 +33,25 @@ class TemperatureDataDownloader:
             days (list[str]): List of days within the month.
         
         Return:
-            str: the month of downloaded data. e.g. "202301"
+            str: the month of downloaded data. e.g. "202301", None if the download or extraction failed.
 
         """
+        tar_name = f'{year}{month}'
+        if self.manifest is not None:
+            # the month is already extracted by a previous run
+            if self.manifest.is_completed(tar_name, days, RunManifest.EXTRACTED):
+                file_names = self.manifest.get_files(tar_name)
+                if all(os.path.exists(os.path.join(tar_name, file_name)) for file_name in file_names):
+                    self.nc_file_list_by_month[tar_name] = file_names
+                    print(f'Resumed extracted files: {tar_name}')
+                    return tar_name
+                print(f'Missing extracted files of {tar_name}, downloading again')
+                self.discard_month(tar_name)
+            # the month is already downloaded by a previous run
+            elif self.manifest.is_completed(tar_name, days, RunManifest.DOWNLOADED) and os.path.isfile(tar_name + '.tar.gz'):
+                print(f'Resumed downloaded files: {tar_name}.tar.gz')
+                return self._extract_downloaded(tar_name, days)
         try:
-            tar_name = f'{year}{month}'
             self.cds_client.retrieve(
                 'sis-agrometeorological-indicators',
                 {
@@ -40,11 +65,49 @@ class TemperatureDataDownloader:
                 },
                 f'{tar_name}.tar.gz'
             )
-            self._list_fileName(tar_name)
             print(f'Downloaded files: {tar_name}.tar.gz')
-            return tar_name
         except Exception as e:
             print(f'Error downloading the data: {e}')
+            return None
+        if self.manifest is not None:
+            self.manifest.mark_stage(tar_name, days, RunManifest.DOWNLOADED)
+        return self._extract_downloaded(tar_name, days)
+
+    def _extract_downloaded(self, tar_name: str, days: list[str]) -> str:
+        """
+        Extract a downloaded month and record it in the manifest.
+
+        Args:
+            tar_name (str): Name of the .tar.gz file without extension, e.g. "202301".
+            days (list[str]): List of days within the month.
+
+        Return:
+            str: the month of extracted data, None if the extraction failed.
+
+        """
+        self._list_fileName(tar_name)
+        if tar_name not in self.nc_file_list_by_month:
+            # a corrupt or truncated archive is downloaded again by the next run
+            self.discard_month(tar_name)
+            return None
+        if self.manifest is not None:
+            self.manifest.mark_stage(tar_name, days, RunManifest.EXTRACTED, self.nc_file_list_by_month[tar_name])
+        return tar_name
+
+    def discard_month(self, tar_name: str):
+        """
+        Remove the downloaded and extracted files of a month and reset its progress in the manifest.
+
+        Args:
+            tar_name (str): Name of the .tar.gz file without extension, e.g. "202301".
+
+        """
+        self.nc_file_list_by_month.pop(tar_name, None)
+        if os.path.isfile(tar_name + '.tar.gz'):
+            os.remove(tar_name + '.tar.gz')
+        shutil.rmtree(tar_name, ignore_errors=True)
+        if self.manifest is not None:
+            self.manifest.reset_month(tar_name)
 
     def _list_fileName(self, tar_name: str):
         """
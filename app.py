@@ -1,5 +1,7 @@
 from GeoJSONProcessor import GeoJSONProcessor
 from TemperatureDataDownloader import TemperatureDataDownloader
+from RunManifest import RunManifest
+from PipelineProfiler import PipelineProfiler
 
 from math import ceil, floor
 from datetime import datetime
@@ -9,8 +11,18 @@ import time
 import argparse
 
 import concurrent.futures
+import hashlib
 import os
 
+RESULT_FILE = 'result.geojson'
+
+# pipeline stages recorded in the profile mode
+PROFILED_STAGES = {
+    GeoJSONProcessor: ['_load_geojson_file', '_find_features_centroids', '_get_sampling_weights',
+                       '_get_daily_temperature_by_month', '_aggregate_monthly_average', 'write_updated_geojson_file'],
+    TemperatureDataDownloader: ['download_temperature_data', '_list_fileName'],
+}
+
 def list_days_of_month(start_date: datetime, end_date: datetime) -> dict:
     """
     List the days of each month within a given date range.
@@ -29,7 +41,104 @@ def list_days_of_month(start_date: datetime, end_date: datetime) -> dict:
 
     return date_dict
 
-def main_multiThread(file_path: str):
+def hash_file(file_path: str) -> str:
+    """
+    Hash the content of a file.
+
+    Args:
+        file_path (str): Path of the file.
+
+    Returns:
+        str: sha256 hex digest of the file.
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def get_download_bbox(bbox: list) -> list:
+    """
+    Round the features' bbox outwards to the area requested from the CDS API.
+
+    Args:
+        bbox (list): Bounding box coordinates [minx, miny, maxx, maxy].
+
+    Returns:
+        list: Area of the request [north, west, south, east] in whole degrees.
+    """
+    # ISSUE: The api seems like not accept the bbox with float number.
+    return [ceil(bbox[3]), floor(bbox[0]), floor(bbox[1]), ceil(bbox[2])]
+
+def create_run_manifest(checkpoint_dir: str, geojson_processor: GeoJSONProcessor, bbox_for_downloader: list) -> RunManifest:
+    """
+    Create the manifest of the run, resuming a previous run of the same input.
+
+    Args:
+        checkpoint_dir (str): Directory of the manifest and the partial results.
+        geojson_processor (GeoJSONProcessor): Processor of the input file.
+        bbox_for_downloader (list): Area requested from the CDS API, see get_download_bbox.
+
+    Returns:
+        RunManifest: Manifest of the run.
+    """
+    # the downloaded and extracted data only depends on the requested area,
+    # features moving inside the rounded area keep the downloads
+    run_key = {
+        'bbox': [int(value) for value in bbox_for_downloader],
+    }
+    # the monthly averages also depend on the features and how they are sampled
+    result_key = {
+        'file_path': os.path.abspath(geojson_processor.file_path),
+        # features edited in place keep the path, bbox and count
+        'file_hash': hash_file(geojson_processor.file_path),
+        'features': len(geojson_processor.names),
+        'sampling_mode': geojson_processor.sampling_mode,
+    }
+    return RunManifest(checkpoint_dir, run_key, result_key)
+
+def resume_aggregated_months(manifest: RunManifest, geojson_processor: GeoJSONProcessor, days_of_month_list: dict) -> set:
+    """
+    Load the monthly averages saved by a previous run into the processor.
+
+    Args:
+        manifest (RunManifest): Manifest of the run.
+        geojson_processor (GeoJSONProcessor): Processor to store the monthly averages.
+        days_of_month_list (dict): Dictionary with month and days for each month.
+
+    Returns:
+        set: Months which do not need to be downloaded and processed again. e.g. {"202301", ...}
+    """
+    resumed_months = set()
+    for (year, month), days in days_of_month_list.items():
+        if not manifest.is_completed(year + month, days, RunManifest.AGGREGATED):
+            continue
+        try:
+            geojson_processor.set_monthly_avg_temperature(year + month, manifest.load_monthly_average(year + month))
+        except (OSError, ValueError) as e:
+            print(f'Error loading the checkpoint of {year}{month}: {e}')
+            continue
+        resumed_months.add(year + month)
+    return resumed_months
+
+def create_profiler(profile_mode: str, trace_memory: bool, top_n: int) -> PipelineProfiler:
+    """
+    Create a profiler recording the pipeline stages.
+
+    Args:
+        profile_mode (str): Profiler to run inside the stages, 'cprofile' or 'sampling'.
+        trace_memory (bool): Trace the memory allocations with tracemalloc.
+        top_n (int): Number of functions and allocation sites in the summary.
+
+    Returns:
+        PipelineProfiler: Profiler with the stages instrumented.
+    """
+    profiler = PipelineProfiler(profile_mode, trace_memory, top_n)
+    for cls, method_names in PROFILED_STAGES.items():
+        profiler.instrument(cls, method_names)
+    return profiler
+
+def main_multiThread(file_path: str, checkpoint_dir: str = 'checkpoint', sampling_mode: str = 'nearest'):
 
     start_date = datetime(2023, 1, 1)
     end_date = datetime.now()
@@ -39,35 +148,67 @@ def main_multiThread(file_path: str):
     # months = ["202301", "202302", ...]
     months = [year + month for year, month in days_of_month_list.keys()]
     
-    downloader = TemperatureDataDownloader()
-    geojson_processor = GeoJSONProcessor(file_path, months)
-
-    # ISSUE: The api seems like not accept the bbox with float number.
-    bbox = geojson_processor.bbox
-    bbox_for_downloader = [ceil(bbox[3]), floor(bbox[0]), floor(bbox[1]), ceil(bbox[2])]
+    geojson_processor = GeoJSONProcessor(file_path, months, sampling_mode)
+    bbox_for_downloader = get_download_bbox(geojson_processor.bbox)
+    manifest = create_run_manifest(checkpoint_dir, geojson_processor, bbox_for_downloader)
+    downloader = TemperatureDataDownloader(manifest)
     
     start_time = time.time()
+    resumed_months = resume_aggregated_months(manifest, geojson_processor, days_of_month_list)
     # Download data: I/O-bound -> Using multi-threading to improve the performance.
     # Note: used limited threads to prevent memory ran out.
     with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
-        # Submit tasks to the ThreadPoolExecutor
-        futures = []
+        # Submit tasks to the ThreadPoolExecutor: {future: month}
+        download_futures = {}
         for year, month in days_of_month_list:
+            if year + month in resumed_months:
+                continue
             days = days_of_month_list[(year, month)]
             future = executor.submit(downloader.download_temperature_data, bbox_for_downloader, year, month, days)
-            futures.append(future)
-        for future in concurrent.futures.as_completed(futures):
-            month = future.result()
-            future = executor.submit(geojson_processor.get_monthly_avg_temperature, 
-                                     downloader.nc_file_list_by_month, month)
-            futures.append(future)
-        # Wait for all tasks to complete
-        concurrent.futures.wait(futures)
+            download_futures[future] = year + month
+        # Workers only compute the month's averages: {future: month}
+        processing_futures = {}
+        # Handle downloads and processings as they complete, so every month is stored and checkpointed
+        # as soon as it is processed, even while other months are still downloading.
+        pending = set(download_futures)
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future in download_futures:
+                    month = download_futures[future]
+                    try:
+                        downloaded_month = future.result()
+                    except Exception as e:
+                        print(f'Error downloading the data of {month}: {e}')
+                        continue
+                    # the download failed, the error is printed by the downloader
+                    if downloaded_month is None:
+                        continue
+                    future = executor.submit(geojson_processor.compute_monthly_avg_temperature,
+                                             downloader.nc_file_list_by_month, month)
+                    processing_futures[future] = month
+                    pending.add(future)
+                    continue
+                # Only the main thread writes the results into the result matrix
+                month = processing_futures[future]
+                try:
+                    monthly_average = future.result()
+                except OSError as e:
+                    print(f'Error reading the data of {month}: {e}')
+                    # the extracted files are missing or corrupt, download the month again in the next run
+                    downloader.discard_month(month)
+                    continue
+                except Exception as e:
+                    # keep the month extracted, the next run only aggregates it again
+                    print(f'Error processing the data of {month}: {e}')
+                    continue
+                geojson_processor.set_monthly_avg_temperature(month, monthly_average)
+                manifest.save_monthly_average(month, days_of_month_list[(month[:4], month[4:])], monthly_average)
     processing_time = time.time() - start_time
 
     start_time = time.time()
     # update geoJSON file
-    geojson_processor.write_updated_geojson_file()
+    geojson_processor.write_updated_geojson_file(RESULT_FILE)
     write_time = time.time() - start_time
 
     print(f"{'*' * 10} Multi-Threading Result {'*' * 10}")
@@ -81,30 +222,52 @@ def main_multiThread(file_path: str):
     print(f"* Write Time: {write_time:.2f} seconds")
     print(f"{'='*50}")
     print(f"* Total Run Time: {processing_time+write_time:.2f} seconds")
+    print_run_progress(manifest, days_of_month_list, resumed_months)
+
+
+def print_run_progress(manifest: RunManifest, days_of_month_list: dict, resumed_months: set):
+    """
+    Print the months resumed from the checkpoint and the months left incomplete.
+
+    Args:
+        manifest (RunManifest): Manifest of the run.
+        days_of_month_list (dict): Dictionary with month and days for each month.
+        resumed_months (set): Months loaded from the checkpoint.
+    """
+    incomplete_months = [year + month for (year, month), days in days_of_month_list.items()
+                         if not manifest.is_completed(year + month, days, RunManifest.AGGREGATED)]
+    print(f"{'='*50}")
+    print(f"* Resumed Months: {sorted(resumed_months)}")
+    if incomplete_months:
+        print(f"* Incomplete Months: {incomplete_months} -> run again to resume from {manifest.manifest_path}")
 
 
-def main_singleThread(file_path):
+def main_singleThread(file_path, checkpoint_dir: str = 'checkpoint', sampling_mode: str = 'nearest'):
     """
     Main function to run the single-threaded processing.
 
     Args:
         file_path (str): Path to the GeoJSON file.
+        checkpoint_dir (str): Directory of the manifest and the partial results.
+        sampling_mode (str): How the temperature of a centroid is sampled from the grid.
 
     """
-    downloader = TemperatureDataDownloader()
     start_date = datetime(2023, 1, 1)
     end_date = datetime.now()
     days_of_month_list = list_days_of_month(start_date, end_date)
     # in order to prevent the concorrent write data to dataframe
     months = [year + month for year, month in days_of_month_list.keys()]
-    geojson_processor = GeoJSONProcessor(file_path, months)
-
-    bbox = geojson_processor.bbox
-    bbox_for_download = [ceil(bbox[3]), floor(bbox[0]), floor(bbox[1]), ceil(bbox[2])]
+    geojson_processor = GeoJSONProcessor(file_path, months, sampling_mode)
+    bbox_for_download = get_download_bbox(geojson_processor.bbox)
+    manifest = create_run_manifest(checkpoint_dir, geojson_processor, bbox_for_download)
+    downloader = TemperatureDataDownloader(manifest)
+    resumed_months = resume_aggregated_months(manifest, geojson_processor, days_of_month_list)
     
     # As the csd api has download items limitation, divide the request by month. 
     download_times = {}
     for year, month in days_of_month_list:
+        if year + month in resumed_months:
+            continue
         start_time = time.time()
         days = days_of_month_list[(year, month)]
         downloader.download_temperature_data(bbox_for_download, year, month, days)
@@ -112,14 +275,27 @@ def main_singleThread(file_path):
         download_times[(year, month)] = download_time
 
     processing_times = {}
-    for month in downloader.nc_file_list_by_month:
+    # copy the months, discard_month removes a failed month from the dict
+    for month in list(downloader.nc_file_list_by_month):
         start_time = time.time()
-        geojson_processor.get_monthly_avg_temperature(downloader.nc_file_list_by_month, month)
+        try:
+            monthly_average = geojson_processor.compute_monthly_avg_temperature(downloader.nc_file_list_by_month, month)
+        except OSError as e:
+            print(f'Error reading the data of {month}: {e}')
+            # the extracted files are missing or corrupt, download the month again in the next run
+            downloader.discard_month(month)
+            continue
+        except Exception as e:
+            # keep the month extracted, the next run only aggregates it again
+            print(f'Error processing the data of {month}: {e}')
+            continue
+        geojson_processor.set_monthly_avg_temperature(month, monthly_average)
+        manifest.save_monthly_average(month, days_of_month_list[(month[:4], month[4:])], monthly_average)
         processing_time = time.time() - start_time
         processing_times[month] = processing_time
 
     start_time = time.time()
-    geojson_processor.write_updated_geojson_file()
+    geojson_processor.write_updated_geojson_file(RESULT_FILE)
     write_time = time.time() - start_time
 
     print(f"{'*' * 10} Single Threading Result {'*' * 10}")
@@ -147,15 +323,34 @@ def main_singleThread(file_path):
     print(f"* Write Time: {write_time:.2f} seconds")
     print(f"{'='*50}")
     print(f"* Total Run Time: {total_download_time+total_processing_time+write_time:.2f} seconds")
+    print_run_progress(manifest, days_of_month_list, resumed_months)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Process temperature data.')
     parser.add_argument('file_path', type=str, help='Path to the GeoJSON file')
+    parser.add_argument('--checkpoint-dir', type=str, default='checkpoint',
+                        help='Directory of the run manifest and partial results used to resume a run')
+    parser.add_argument('--sampling', type=str, default='nearest', choices=GeoJSONProcessor.SAMPLING_MODES,
+                        help='Sample the nearest grid cell or interpolate the surrounding cells (bilinear / idw)')
+    parser.add_argument('--profile', type=str, default=None, choices=PipelineProfiler.MODES,
+                        help='Profile the pipeline stages and write the reports next to the result file')
+    parser.add_argument('--trace-memory', action='store_true', help='Trace memory allocations with tracemalloc when profiling')
+    parser.add_argument('--profile-top', type=int, default=20, help='Number of hot functions in the profile summary')
     args = parser.parse_args()
 
-    # main_singleThread(args.file_path)
-    main_multiThread(args.file_path)
+    profiler = None
+    if args.profile is not None:
+        profiler = create_profiler(args.profile, args.trace_memory, args.profile_top)
+        profiler.start()
+    try:
+        # main_singleThread(args.file_path, args.checkpoint_dir, args.sampling)
+        main_multiThread(args.file_path, args.checkpoint_dir, args.sampling)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            report_paths = profiler.write_report(os.path.splitext(RESULT_FILE)[0])
+            print(f"* Profile Reports: {report_paths}")
 
     # main_singleThread('test_features.geojson')
     # main_multiThread('test_features.geojson')
@@ -1,27 +1,47 @@
 import geopandas as gpd
 import pandas as pd
-import netCDF4 as nc  
-from collections import defaultdict
-from shapely.geometry import Point
+import numpy as np
+import netCDF4 as nc
 
 
 class GeoJSONProcessor:
     """Class to process GeoJSON files and calculate monthly average temperature."""
 
-    def __init__(self, file_path: str, months: list[str]):
+    # nearest: value of the nearest grid cell
+    # bilinear: bilinear interpolation of the 4 surrounding grid cells
+    # idw: inverse distance weighting of the 4 surrounding grid cells
+    SAMPLING_MODES = ['nearest', 'bilinear', 'idw']
+
+    def __init__(self, file_path: str, months: list[str], sampling_mode: str = 'nearest'):
         """
         Initialize GeoJSONProcessor.
 
         Args:
             file_path (str): Path to the GeoJSON file.
+            months (list[str]): Months to calculate, e.g. ["202301", "202302", ...]
+            sampling_mode (str): How the temperature of a centroid is sampled from the grid, one of SAMPLING_MODES.
+
+        Raises:
+            ValueError: If the sampling mode is not supported.
 
         """
+        if sampling_mode not in self.SAMPLING_MODES:
+            raise ValueError(f'Unsupported sampling mode: {sampling_mode}, expected one of {self.SAMPLING_MODES}')
         self.file_path: str = file_path
+        self.sampling_mode: str = sampling_mode
+        self.months: list[str] = list(months)
+        # {'202301': 0, '202302': 1, ...} -> column of the month in the result matrix
+        self.month_index: dict = {month: idx for idx, month in enumerate(self.months)}
         self.gdf: gpd.GeoDataFrame = self._load_geojson_file()
         self.bbox: list = self._calculate_bbox()
-        self.df_centroids: pd.DataFrame = self._find_features_centroids()
-        self.df_monthly_average_temp = pd.DataFrame(self.df_centroids["name"], columns=['name']+months)
-    
+        self.names: np.ndarray = self.gdf['name'].to_numpy()
+        self.centroid_x, self.centroid_y = self._find_features_centroids()
+        # (lat, lon, lon_idx, lat_idx, flat_idx, weights) of the last seen grid, filled by _get_sampling_weights.
+        # Replaced as a whole tuple so worker threads never see a half updated grid.
+        self._sampling_grid: tuple = None
+        # (features x months) monthly average temperature, NaN until the month is processed
+        self.monthly_average_temp: np.ndarray = np.full((len(self.names), len(self.months)), np.nan, dtype=np.float32)
+
     def __str__(self):
         """
         Return string representation of GeoJSONProcessor.
@@ -39,13 +59,15 @@ class GeoJSONProcessor:
             f"{'='*50}\n"
             f"* Bounding Box: {self.bbox}\n"
             f"{'='*50}\n"
+            f"* Sampling Mode: {self.sampling_mode}\n"
+            f"{'='*50}\n"
             f"* Centroids of features (head): \n"
-            f"{self.df_centroids.head()}\n"
+            f"{self.centroids_to_dataframe().head()}\n"
             f"{'='*50}\n"
             f"* Monthly average temperature: \n"
-            f"{self.df_monthly_average_temp}\n"
+            f"{self.monthly_average_to_dataframe()}\n"
         )
-        
+
     def _load_geojson_file(self) -> gpd.GeoDataFrame:
         """
         Load the GeoJSON file.
@@ -57,7 +79,7 @@ class GeoJSONProcessor:
             Exception: If there is an error loading the GeoJSON file.
 
         """
-        try: 
+        try:
             gdf = gpd.read_file(self.file_path)
         except Exception as e:
             raise Exception(f'Error loading the GeoJSON file: {e}')
@@ -72,36 +94,80 @@ class GeoJSONProcessor:
 
         """
         return self.gdf.total_bounds
-        
-    def _find_features_centroids(self) -> pd.DataFrame:
+
+    def _find_features_centroids(self) -> tuple:
         """
         Find the centroids of the features.
 
         Returns:
-            pd.DataFrame: DataFrame containing the feature names and their centroids.
+            tuple: float64 arrays of the centroids' coordinates (x, y).
 
         """
         centroids = self.gdf.geometry.centroid
-        df = pd.DataFrame({'name': self.gdf['name'], 'centroid': centroids})
+        return centroids.x.to_numpy(dtype=np.float64), centroids.y.to_numpy(dtype=np.float64)
 
+    def centroids_to_dataframe(self) -> pd.DataFrame:
+        """
+        Build a DataFrame of the centroids and their nearest datapoint for display.
+
+        Returns:
+            pd.DataFrame: DataFrame with name, centroid and nearest grid index of each feature.
+
+        """
+        if self._sampling_grid is None:
+            lon_idx = lat_idx = np.full(len(self.names), -1, dtype=np.int32)
+        else:
+            lon_idx, lat_idx = self._sampling_grid[2:4]
+        return pd.DataFrame({
+            'name': self.names,
+            'centroid_x': self.centroid_x,
+            'centroid_y': self.centroid_y,
+            'nearest_lon_idx': lon_idx,
+            'nearest_lat_idx': lat_idx,
+        })
+
+    def monthly_average_to_dataframe(self) -> pd.DataFrame:
+        """
+        Build a DataFrame of the monthly average temperature for display and output.
+
+        Returns:
+            pd.DataFrame: DataFrame with the feature name and one column per month (YYYYMM).
+
+        """
+        df = pd.DataFrame(self.monthly_average_temp.astype(np.float64), columns=self.months, index=self.gdf.index)
+        df.insert(0, 'name', self.names)
         return df
 
-    def get_monthly_avg_temperature(self, nc_file_list_by_month: dict, month: str):
+    def compute_monthly_avg_temperature(self, nc_file_list_by_month: dict, month: str) -> np.ndarray:
         """
-        Calculate the monthly average temperature.
+        Calculate the monthly average temperature without touching the result matrix.
+
+        Safe to call from worker threads; the caller stores the result with set_monthly_avg_temperature.
 
         Args:
             nc_file_list_by_month (dict): Dictionary containing the list of netCDF file names by month.
-            - e.g. {'202301':[nc_file_name,...],'202302':[nc_file_name]}
-
             month (str): Month for which to calculate the average temperature.
+
+        Returns:
+            np.ndarray: float32 array with the monthly average temperature of each centroid.
+
+        """
+        # daily_temperature -> (days x features) array
+        daily_temperature = self._get_daily_temperature_by_month(nc_file_list_by_month, month)
+        return self._aggregate_monthly_average(daily_temperature)
+
+    def set_monthly_avg_temperature(self, month: str, monthly_average: np.ndarray):
         """
-        # daily_temperature_by_month -> {month_1:{centroid_1:[temp_d1,temp_d2....],centroid_2:[...] }}
-        daily_temperature_by_month = self._get_daily_temperature_by_month(nc_file_list_by_month, month)
-        # self.df_monthly_average_temp[month] -> {month:[avg_temp_centroid_i,...],month_2:[avg_temp_centroid_i,...]} 
-        self.df_monthly_average_temp[month] = self._aggregate_monthly_average(daily_temperature_by_month, month)
+        Write the monthly average temperature into the month's column of the result matrix.
+
+        Args:
+            month (str): Month of the values, e.g. "202301".
+            monthly_average (np.ndarray): Monthly average temperature of each centroid.
 
-    def _get_daily_temperature_by_month(self, nc_file_list_by_month: dict, month: str) -> dict:
+        """
+        self.monthly_average_temp[:, self.month_index[month]] = monthly_average
+
+    def _get_daily_temperature_by_month(self, nc_file_list_by_month: dict, month: str) -> np.ndarray:
         """
         Retrieve the daily temperature values for each centroid point in a given month.
 
@@ -110,95 +176,228 @@ class GeoJSONProcessor:
             month (str): Month for which to retrieve the temperature values.
 
         Returns:
-            dict: Dictionary with daily temperature values for each centroid.
+            np.ndarray: float32 array (days x features) with the daily temperature of each centroid in celsius.
 
         """
-        # {month:{controid_id: []}}
-        daily_temperature_by_month = defaultdict(lambda: defaultdict(list))        
-        
+        file_names = nc_file_list_by_month[month]
+        daily_temperature = np.empty((len(file_names), len(self.names)), dtype=np.float32)
+
         # iterate the files of the target month
-        for file_name in nc_file_list_by_month[month]:
-        
-            # load temperature dataset 
-            dataset = nc.Dataset(month+'/'+file_name)
+        for day_idx, file_name in enumerate(file_names):
 
-            # get lat and lon list from the dataset
-            lat = dataset.variables['lat'][:]
-            lon = dataset.variables['lon'][:]
+            # load temperature dataset
+            with nc.Dataset(month+'/'+file_name) as dataset:
 
-            # get the daily temperature of each centroid   
-            for centroid_idx in range(len(self.df_centroids.centroid)):
+                # get lat and lon list from the dataset
+                lat = dataset.variables['lat'][:]
+                lon = dataset.variables['lon'][:]
 
-                # Find nearest datapoints' index of features' centroid
-                nearest_idx = self._identify_nearest_datapoint(lat, lon, centroid_idx)
-                
-                # Fetch daily temperature data from downloaded data with nearest location index and convert it to celsius
-                temperature_value = dataset['Temperature_Air_2m_Mean_24h'][0][nearest_idx[1]][nearest_idx[0]] - 273.15
-                
-                # Update the dictionary: {month_1:{centroid_1:[temp_d1,temp_d2....],centroid_2:[...] }}
-                daily_temperature_by_month[month][centroid_idx].append(temperature_value)
+                # Find the datapoints and their weights for features' centroid
+                flat_idx, weights = self._get_sampling_weights(lat, lon)
 
-        return daily_temperature_by_month
-        
-    def _identify_nearest_datapoint(self, lat, lon, centroid_idx: int) -> tuple:
+                # Fetch daily temperature data of all centroids at once and convert it to celsius
+                field = np.ma.filled(dataset['Temperature_Air_2m_Mean_24h'][0].astype(np.float32), np.nan)
+                daily_temperature[day_idx] = self._sample_field(field, flat_idx, weights) - 273.15
+
+        return daily_temperature
+
+    def _get_sampling_weights(self, lat, lon) -> tuple:
         """
-        Identify the nearest available temperature datapoint for a centroid.
+        Get the datapoints and weights used to sample the temperature of every centroid.
+
+        The weights are only recomputed when the grid differs from the previous call,
+        as all files of a run share the same grid. The cache is swapped as one tuple,
+        so concurrent callers at worst compute the same weights twice.
 
         Args:
             lat (np.ndarray): Array of latitude values.
             lon (np.ndarray): Array of longitude values.
-            centroid_idx (int): Index of the centroid.
 
         Returns:
-            tuple: Indices of the nearest datapoint (lon_index, lat_index).
-        
+            tuple: (features x k) int32 indices into the flattened (lat, lon) field and float32 weights (flat_idx, weights).
+            - k is 1 for nearest and 4 for bilinear and idw.
+
+        """
+        lat = np.ma.filled(lat, np.nan).astype(np.float64)
+        lon = np.ma.filled(lon, np.nan).astype(np.float64)
+        sampling_grid = self._sampling_grid
+        if sampling_grid is not None and np.array_equal(sampling_grid[0], lat) and np.array_equal(sampling_grid[1], lon):
+            return sampling_grid[4], sampling_grid[5]
+
+        lon_idx, lat_idx = self._identify_nearest_datapoint(lat, lon)
+        if self.sampling_mode == 'nearest':
+            flat_idx = (lat_idx.astype(np.int64) * len(lon) + lon_idx)[:, np.newaxis]
+            weights = np.ones(flat_idx.shape, dtype=np.float32)
+        else:
+            flat_idx, weights = self._interpolation_weights(lat, lon)
+        flat_idx = flat_idx.astype(np.int32)
+        self._sampling_grid = (lat, lon, lon_idx, lat_idx, flat_idx, weights)
+
+        return flat_idx, weights
+
+    def _identify_nearest_datapoint(self, lat: np.ndarray, lon: np.ndarray) -> tuple:
+        """
+        Identify the nearest available temperature datapoint for every centroid.
+
+        Args:
+            lat (np.ndarray): Array of latitude values.
+            lon (np.ndarray): Array of longitude values.
+
+        Returns:
+            tuple: int32 arrays with the indices of the nearest datapoints (lon_index, lat_index).
+
         Issue:
             the horizontal resolution(0.1° x 0.1°) is not enough to map each centroids with different point.
+            -> use the bilinear or idw sampling mode to interpolate between the grid cells.
+        """
+        # find the nearest lat, lon index for all centroids
+        lat_idx = self._nearest_axis_index(lat, self.centroid_y)
+        lon_idx = self._nearest_axis_index(lon, self.centroid_x)
+        return lon_idx, lat_idx
+
+    def _interpolation_weights(self, lat: np.ndarray, lon: np.ndarray) -> tuple:
         """
-        centroid_point = self.df_centroids.centroid.iloc[centroid_idx]
-        
-        # find the nearest lat, lon index for the centroid
-        lat_index = (abs(lat - centroid_point.y)).argmin()
-        lon_index = (abs(lon - centroid_point.x)).argmin()
-        
-        # update the information to centorid df
-        self.df_centroids.at[centroid_idx, 'nearest_point'] = Point(lon[lon_index], lat[lat_index])
-        self.df_centroids.at[centroid_idx, 'nearest_idx'] = Point(lon_index, lat_index)
+        Calculate the bilinear or inverse distance weights of the 4 grid cells surrounding every centroid.
+
+        Centroids outside the grid use the cells on the grid's edge.
 
-        return (lon_index, lat_index)
+        Args:
+            lat (np.ndarray): Array of latitude values.
+            lon (np.ndarray): Array of longitude values.
+
+        Returns:
+            tuple: (features x 4) indices into the flattened (lat, lon) field and float32 weights (flat_idx, weights).
+
+        """
+        lat0, lat1, lat_t = self._bracket_axis_index(lat, self.centroid_y)
+        lon0, lon1, lon_t = self._bracket_axis_index(lon, self.centroid_x)
+        # corners: (lat0, lon0), (lat0, lon1), (lat1, lon0), (lat1, lon1)
+        corner_lat = np.stack([lat0, lat0, lat1, lat1], axis=1)
+        corner_lon = np.stack([lon0, lon1, lon0, lon1], axis=1)
+        flat_idx = corner_lat.astype(np.int64) * len(lon) + corner_lon
+
+        if self.sampling_mode == 'bilinear':
+            weights = np.stack([
+                (1 - lat_t) * (1 - lon_t),
+                (1 - lat_t) * lon_t,
+                lat_t * (1 - lon_t),
+                lat_t * lon_t,
+            ], axis=1)
+        else:
+            # squared distance in degrees, longitude scaled to the centroid's latitude
+            dx = (lon[corner_lon] - self.centroid_x[:, np.newaxis]) * np.cos(np.radians(self.centroid_y))[:, np.newaxis]
+            dy = lat[corner_lat] - self.centroid_y[:, np.newaxis]
+            distance2 = dx ** 2 + dy ** 2
+            exact = distance2 == 0
+            # a centroid on a grid cell takes the cell's value
+            weights = np.where(exact.any(axis=1, keepdims=True), exact, 1 / np.where(exact, 1, distance2))
+            # a single row or column grid has duplicated corners
+            weights[:, 1] = np.where(lon0 == lon1, 0, weights[:, 1])
+            weights[:, 2] = np.where(lat0 == lat1, 0, weights[:, 2])
+            weights[:, 3] = np.where((lon0 == lon1) | (lat0 == lat1), 0, weights[:, 3])
+            weights = weights / weights.sum(axis=1, keepdims=True)
+
+        return flat_idx, weights.astype(np.float32)
+
+    @staticmethod
+    def _bracket_axis_index(axis: np.ndarray, values: np.ndarray) -> tuple:
+        """
+        Find the two axis values surrounding each value.
+
+        Args:
+            axis (np.ndarray): 1-D coordinate axis of the grid (ascending or descending).
+            values (np.ndarray): Coordinates to look up.
+
+        Returns:
+            tuple: indices into axis of the lower and upper neighbour, and the position of each value
+            between them in [0, 1] (lower_index, upper_index, fraction).
 
-    def _aggregate_monthly_average(self, daily_temperature_by_month: dict, month: str) -> pd.Series:
+        """
+        if len(axis) == 1:
+            zeros = np.zeros(len(values), dtype=np.int32)
+            return zeros, zeros, np.zeros(len(values))
+        order = np.argsort(axis, kind='stable')
+        sorted_axis = axis[order]
+        upper = np.clip(np.searchsorted(sorted_axis, values), 1, len(sorted_axis) - 1)
+        lower = upper - 1
+        fraction = np.clip((values - sorted_axis[lower]) / (sorted_axis[upper] - sorted_axis[lower]), 0, 1)
+        return order[lower].astype(np.int32), order[upper].astype(np.int32), fraction
+
+    @staticmethod
+    def _sample_field(field: np.ndarray, flat_idx: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        """
+        Sample a (lat, lon) field with one weighted gather.
+
+        Missing datapoints are left out and the remaining weights renormalised.
+
+        Args:
+            field (np.ndarray): 2-D field with NaN for missing values.
+            flat_idx (np.ndarray): (features x k) indices into the flattened field.
+            weights (np.ndarray): (features x k) weights of the datapoints.
+
+        Returns:
+            np.ndarray: float32 array with the sampled value of each centroid, NaN if all datapoints are missing.
+
+        """
+        values = field.ravel()[flat_idx]
+        valid = ~np.isnan(values)
+        weights = np.where(valid, weights, 0)
+        total_weight = weights.sum(axis=1)
+        weighted_sum = (np.where(valid, values, 0) * weights).sum(axis=1)
+        return np.divide(weighted_sum, total_weight, out=np.full(len(total_weight), np.nan, dtype=np.float32), where=total_weight > 0)
+
+    @staticmethod
+    def _nearest_axis_index(axis: np.ndarray, values: np.ndarray) -> np.ndarray:
+        """
+        Find the index of the nearest axis value for each value.
+
+        Args:
+            axis (np.ndarray): 1-D coordinate axis of the grid (ascending or descending).
+            values (np.ndarray): Coordinates to look up.
+
+        Returns:
+            np.ndarray: int32 array with the index into axis of each value.
+
+        """
+        order = np.argsort(axis, kind='stable')
+        sorted_axis = axis[order]
+        # neighbours of each value in the sorted axis, clipped to the axis range
+        right = np.clip(np.searchsorted(sorted_axis, values), 0, len(sorted_axis) - 1)
+        left = np.maximum(right - 1, 0)
+        nearest = np.where(np.abs(values - sorted_axis[left]) <= np.abs(sorted_axis[right] - values), left, right)
+        return order[nearest].astype(np.int32)
+
+    def _aggregate_monthly_average(self, daily_temperature: np.ndarray) -> np.ndarray:
         """
         Calculate the monthly average temperature for each centroid.
 
         Args:
-            daily_temperature_by_month (dict): Dictionary with daily temperature values for each centroid.
-            month (str): Month for which to calculate the average.
+            daily_temperature (np.ndarray): (days x features) array with the daily temperature of each centroid.
 
         Returns:
-            pd.Series: Series with monthly average temperature values.
+            np.ndarray: float32 array with the monthly average temperature of each centroid.
 
         """
-        monthly_averages = []
-        for centroid, temperatures in daily_temperature_by_month[month].items():
-            avg_temperature = sum(temperatures) / len(temperatures)
-            monthly_averages.append(avg_temperature)
-        return monthly_averages
+        return daily_temperature.mean(axis=0, dtype=np.float64).astype(np.float32)
 
     def _update_geojson_properties(self):
         """
-        Merge the input gdf with the monthly average temperature dataframe.
+        Add the monthly average temperature columns to the input gdf.
 
         Returns:
             None.
 
         """
-        self.gdf = pd.merge(self.gdf, self.df_monthly_average_temp, on='name', how='outer')
+        df_monthly_average_temp = self.monthly_average_to_dataframe().drop(columns='name')
+        self.gdf = gpd.GeoDataFrame(pd.concat([self.gdf, df_monthly_average_temp], axis=1), geometry=self.gdf.geometry.name, crs=self.gdf.crs)
 
-    def write_updated_geojson_file(self):
+    def write_updated_geojson_file(self, output_path: str = 'result.geojson'):
         """
         Write the updated GeoJSON file.
 
+        Args:
+            output_path (str): Path of the output GeoJSON file.
+
         """
         self._update_geojson_properties()
-        self.gdf.to_file('result.geojson', driver="GeoJSON")  
\ No newline at end of file
+        self.gdf.to_file(output_path, driver="GeoJSON")